@@ -10,21 +10,28 @@ Get waypoint from load_arrays_from_file
 
 """
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
 import time
 import cvxpy
 import math
 import numpy as np
+import os
 import sys
-from simple_pid import PID
+import hashlib
+import importlib
+import multiprocessing
+import queue
+import subprocess
+from numba import njit
 
 from scipy.spatial.transform import Rotation as Rot
+from scipy.linalg import solve_banded
 import pathlib
+from dataclasses import dataclass
 sys.path.append(str(pathlib.Path(__file__).parent.parent.parent))
 
 from pyproj import Transformer
-import bisect
 from geometry_msgs.msg import Twist
-from transforms3d.euler import quat2euler
 
 from ros_tools import *
 
@@ -44,10 +51,16 @@ MAX_TIME = 500.0  # max simulation time
 # iterative paramter
 MAX_ITER = 3  # Max iteration
 DU_TH = 0.1  # iteration finish param
+DX_TH = 0.01  # iteration finish param, max change of the predicted states
+MODEL_EPS = 1e-10  # stands in for exact zeros of the linear model entries
+MPC_DECIMATION = 2  # do_mpc solves every n-th DT step of the horizon, at most T
 
 TARGET_SPEED = 15.0 / 3.6  # [m/s] target speed
 N_IND_SEARCH = 10  # Search index number
 
+# course.xy is one (N, 5) array with the columns cx, cy, cyaw, ck, sp
+COURSE_XREF = np.array([0, 1, 4, 2])  # course columns of the state x, y, v, yaw
+
 DT = 0.2  # [s] time tick
 
 # Vehicle parameters
@@ -66,12 +79,31 @@ MIN_SPEED = 0.0 / 3.6  # minimum speed [m/s]
 MAX_ACCEL = 1.0  # maximum accel [m/ss]
 
 show_animation = True
+animation_step = 1  # draw the animation every n-th MPC tick
+
+# C solver of the mpc qp generated offline by generate_mpc_solver
+# horizon, weights and bounds are compiled in, so the directory is keyed on them
+MPC_GEN_LAYOUT = 2  # bump when the variables or parameters of the qp change
+MPC_GEN_KEY = hashlib.sha1(repr((MPC_GEN_LAYOUT, T, NX, NU, Q, Qf, R, Rd, DT, MAX_STEER, MAX_DSTEER,
+                                 MAX_SPEED, MIN_SPEED, MAX_ACCEL)).encode()).hexdigest()[:10]
+MPC_GEN_DIR = pathlib.Path(__file__).parent / f'ws_mpc_gen_{MPC_GEN_KEY}'
+try:
+    cpg_solve = importlib.import_module(f'{MPC_GEN_DIR.name}.cpg_solver').cpg_solve
+except ImportError:
+    cpg_solve = None
+
+# OSQP renamed its polish option to polishing in 1.0, pick it like cvxpy does
+try:
+    import osqp
+    OSQP_POLISH = 'polish' if int(osqp.__version__.split('.')[0]) < 1 else 'polishing'
+except ImportError:
+    OSQP_POLISH = 'polishing'
 
 
 class GNSStoUTMConverter:
     def __init__(self):
-        # Initialize the converter
-        pass
+        # Initialize the converter, transformers are cached by UTM zone
+        self._transformers = {}
 
     def determine_utm_zone(self, lon):
         # Determine the UTM zone based on longitude
@@ -81,12 +113,15 @@ class GNSStoUTMConverter:
         # Convert GNSS coordinates to UTM
         zone_number = self.determine_utm_zone(lon)
         
-        # Create a transformer object
-        transformer = Transformer.from_crs(
-            "EPSG:4326",  # WGS84 GNSS coordinate system
-            f"+proj=utm +zone={zone_number} +datum=WGS84",  # UTM coordinate system
-            always_xy=True
-        )
+        # Create a transformer object once per zone
+        transformer = self._transformers.get(zone_number)
+        if transformer is None:
+            transformer = Transformer.from_crs(
+                "EPSG:4326",  # WGS84 GNSS coordinate system
+                f"+proj=utm +zone={zone_number} +datum=WGS84",  # UTM coordinate system
+                always_xy=True
+            )
+            self._transformers[zone_number] = transformer
         
         # Perform the transformation
         easting, northing = transformer.transform(lon, lat)
@@ -133,26 +168,23 @@ class CubicSpline1D:
         if np.any(h < 0):
             raise ValueError("x coordinates must be sorted in ascending order")
 
-        self.a, self.b, self.c, self.d = [], [], [], []
         self.x = x
         self.y = y
+        self.x_arr = np.ascontiguousarray(x, dtype=np.float64)
         self.nx = len(x)  # dimension of x
 
         # calc coefficient a
-        self.a = [iy for iy in y]
+        self.a = np.asarray(y, dtype=np.float64)
 
         # calc coefficient c
         A = self.__calc_A(h)
         B = self.__calc_B(h, self.a)
-        self.c = np.linalg.solve(A, B)
+        self.c = solve_banded((1, 1), A, B)
 
         # calc spline coefficient b and d
-        for i in range(self.nx - 1):
-            d = (self.c[i + 1] - self.c[i]) / (3.0 * h[i])
-            b = 1.0 / h[i] * (self.a[i + 1] - self.a[i]) \
-                - h[i] / 3.0 * (2.0 * self.c[i] + self.c[i + 1])
-            self.d.append(d)
-            self.b.append(b)
+        self.d = (self.c[1:] - self.c[:-1]) / (3.0 * h)
+        self.b = (self.a[1:] - self.a[:-1]) / h \
+            - h / 3.0 * (2.0 * self.c[:-1] + self.c[1:])
 
     def calc_position(self, x):
         """
@@ -171,9 +203,9 @@ class CubicSpline1D:
             return None
 
         i = self.__search_index(x)
-        dx = x - self.x[i]
+        dx = x - self.x_arr[i]
         position = self.a[i] + self.b[i] * dx + \
-            self.c[i] * dx ** 2.0 + self.d[i] * dx ** 3.0
+            (self.c[i] + self.d[i] * dx) * dx * dx
 
         return position
 
@@ -195,8 +227,8 @@ class CubicSpline1D:
             return None
 
         i = self.__search_index(x)
-        dx = x - self.x[i]
-        dy = self.b[i] + 2.0 * self.c[i] * dx + 3.0 * self.d[i] * dx ** 2.0
+        dx = x - self.x_arr[i]
+        dy = self.b[i] + 2.0 * self.c[i] * dx + 3.0 * self.d[i] * dx * dx
         return dy
 
     def calc_second_derivative(self, x):
@@ -217,31 +249,76 @@ class CubicSpline1D:
             return None
 
         i = self.__search_index(x)
-        dx = x - self.x[i]
+        dx = x - self.x_arr[i]
         ddy = 2.0 * self.c[i] + 6.0 * self.d[i] * dx
         return ddy
 
+    def calc_position_vec(self, x):
+        """
+        Calc `y` positions for an array of `x`.
+
+        `y` is NaN where `x` is outside the data point's `x` range.
+
+        Returns
+        -------
+        y : ndarray
+            y positions for given x.
+        """
+        x, i, dx = self.__segment_vec(x)
+        position = self.a[i] + self.b[i] * dx + \
+            (self.c[i] + self.d[i] * dx) * dx * dx
+        return self.__mask_outside(x, position)
+
+    def calc_first_derivative_vec(self, x):
+        """
+        Calc first derivatives for an array of `x`, NaN outside the input x.
+        """
+        x, i, dx = self.__segment_vec(x)
+        dy = self.b[i] + 2.0 * self.c[i] * dx + 3.0 * self.d[i] * dx * dx
+        return self.__mask_outside(x, dy)
+
+    def calc_second_derivative_vec(self, x):
+        """
+        Calc second derivatives for an array of `x`, NaN outside the input x.
+        """
+        x, i, dx = self.__segment_vec(x)
+        ddy = 2.0 * self.c[i] + 6.0 * self.d[i] * dx
+        return self.__mask_outside(x, ddy)
+
     def __search_index(self, x):
         """
         search data segment index
         """
-        return bisect.bisect(self.x, x) - 1
+        return int(np.searchsorted(self.x_arr, x, side='right')) - 1
+
+    def __search_index_vec(self, x):
+        """
+        search data segment indices of an array of x
+        """
+        i = np.searchsorted(self.x_arr, x, side='right') - 1
+        return np.clip(i, 0, self.nx - 2)
+
+    def __segment_vec(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        i = self.__search_index_vec(x)
+        return x, i, x - self.x_arr[i]
+
+    def __mask_outside(self, x, y):
+        return np.where((x < self.x_arr[0]) | (x > self.x_arr[-1]), np.nan, y)
 
     def __calc_A(self, h):
         """
         calc matrix A for spline coefficient c
+
+        A is tridiagonal, so it is returned in the (3, nx) banded form of
+        scipy.linalg.solve_banded: super diagonal, diagonal, sub diagonal.
         """
-        A = np.zeros((self.nx, self.nx))
-        A[0, 0] = 1.0
-        for i in range(self.nx - 1):
-            if i != (self.nx - 2):
-                A[i + 1, i + 1] = 2.0 * (h[i] + h[i + 1])
-            A[i + 1, i] = h[i]
-            A[i, i + 1] = h[i]
-
-        A[0, 1] = 0.0
-        A[self.nx - 1, self.nx - 2] = 0.0
-        A[self.nx - 1, self.nx - 1] = 1.0
+        A = np.zeros((3, self.nx))
+        A[0, 2:] = h[1:]
+        A[1, 0] = 1.0
+        A[1, 1:-1] = 2.0 * (h[:-1] + h[1:])
+        A[1, -1] = 1.0
+        A[2, :-2] = h[:-1]
         return A
 
     def __calc_B(self, h, a):
@@ -249,9 +326,8 @@ class CubicSpline1D:
         calc matrix B for spline coefficient c
         """
         B = np.zeros(self.nx)
-        for i in range(self.nx - 2):
-            B[i + 1] = 3.0 * (a[i + 2] - a[i + 1]) / h[i + 1]\
-                - 3.0 * (a[i + 1] - a[i]) / h[i]
+        B[1:-1] = 3.0 * (a[2:] - a[1:-1]) / h[1:] \
+            - 3.0 * (a[1:-1] - a[:-2]) / h[:-1]
         return B
 
 class CubicSpline2D:
@@ -390,17 +466,37 @@ class CubicSpline2D:
         yaw = math.atan2(dy, dx)
         return yaw
 
+    def calc_position_vec(self, s):
+        """
+        calc positions for an array of s, NaN outside the data point's range
+        """
+        return self.sx.calc_position_vec(s), self.sy.calc_position_vec(s)
+
+    def calc_curvature_vec(self, s):
+        """
+        calc curvatures for an array of s
+        """
+        dx = self.sx.calc_first_derivative_vec(s)
+        ddx = self.sx.calc_second_derivative_vec(s)
+        dy = self.sy.calc_first_derivative_vec(s)
+        ddy = self.sy.calc_second_derivative_vec(s)
+        return (ddy * dx - ddx * dy) / ((dx ** 2 + dy ** 2)**(3 / 2))
+
+    def calc_yaw_vec(self, s):
+        """
+        calc yaw angles (tangent vector) for an array of s
+        """
+        dx = self.sx.calc_first_derivative_vec(s)
+        dy = self.sy.calc_first_derivative_vec(s)
+        return np.arctan2(dy, dx)
+
 def calc_spline_course(x, y, ds=0.1):
     sp = CubicSpline2D(x, y)
-    s = list(np.arange(0, sp.s[-1], ds))
+    s = np.arange(0, sp.s[-1], ds)
 
-    rx, ry, ryaw, rk = [], [], [], []
-    for i_s in s:
-        ix, iy = sp.calc_position(i_s)
-        rx.append(ix)
-        ry.append(iy)
-        ryaw.append(sp.calc_yaw(i_s))
-        rk.append(sp.calc_curvature(i_s))
+    rx, ry = sp.calc_position_vec(s)
+    ryaw = sp.calc_yaw_vec(s)
+    rk = sp.calc_curvature_vec(s)
 
     return rx, ry, ryaw, rk, s
 
@@ -463,47 +559,82 @@ def angle_mod(x, zero_2_2pi=False, degree=False):
     else:
         return mod_angle
 
+def _state_field(i):
+    return property(lambda self: float(self.vec[i]),
+                    lambda self, value: self.vec.__setitem__(i, value))
+
 class State:
     """
     vehicle state class
+
+    the state is one float64 array vec in the mpc order x, y, v, yaw,
+    the attributes read and write its entries
     """
 
+    x = _state_field(0)
+    y = _state_field(1)
+    v = _state_field(2)
+    yaw = _state_field(3)
+
     def __init__(self, x=0.0, y=0.0, yaw=0.0, v=0.0):
-        self.x = x
-        self.y = y
-        self.yaw = yaw
-        self.v = v
+        self.vec = np.array([x, y, v, yaw], dtype=np.float64)
         self.predelta = None
 
+@njit(cache=True)
 def pi_2_pi(angle):
-    return angle_mod(angle)
-
-def get_linear_model_matrix(v, phi, delta):
-
-    A = np.zeros((NX, NX))
-    A[0, 0] = 1.0
-    A[1, 1] = 1.0
-    A[2, 2] = 1.0
-    A[3, 3] = 1.0
-    A[0, 2] = DT * math.cos(phi)
-    A[0, 3] = - DT * v * math.sin(phi)
-    A[1, 2] = DT * math.sin(phi)
-    A[1, 3] = DT * v * math.cos(phi)
-    A[3, 2] = DT * math.tan(delta) / WB
-
-    B = np.zeros((NX, NU))
-    B[2, 0] = DT
-    B[3, 1] = DT * v / (WB * math.cos(delta) ** 2)
+    """
+    scalar angle_mod, [-pi, pi) without the ndarray round trip
+    use angle_mod for arrays
+    """
+    return (angle + math.pi) % (2.0 * math.pi) - math.pi
 
-    C = np.zeros(NX)
-    C[0] = DT * v * math.sin(phi) * phi
-    C[1] = - DT * v * math.cos(phi) * phi
-    C[3] = - DT * v * delta / (WB * math.cos(delta) ** 2)
+@njit(cache=True, fastmath=True)
+def structural(value):
+    """
+    entry of the linear model that is nonzero in the qp sparsity pattern
+    """
+    return value if value != 0.0 else MODEL_EPS
 
-    return A, B, C
+@njit(cache=True, fastmath=True)
+def build_linear_model_batch(xbar, dref, A, B, C):
+    """
+    fill the linearized models of the whole horizon in place, one pass per step
+    A (T, NX, NX), B (T, NX, NU), C (T, NX) at the operating points xbar, dref
 
-def plot_car(x, y, yaw, steer=0.0, cabcolor="-r", truckcolor="-k"):  # pragma: no cover
+    v, phi or delta at exactly 0 zero out model entries and would change the
+    sparsity of the qp, which forces a cold OSQP setup, they are kept tiny
+    """
+    A[:] = 0.0
+    B[:] = 0.0
+    C[:] = 0.0
 
+    for t in range(T):
+        v = xbar[2, t]
+        phi = xbar[3, t]
+        delta = dref[0, t]
+
+        cos_phi = math.cos(phi)
+        sin_phi = math.sin(phi)
+        cos_delta2 = math.cos(delta) ** 2
+
+        A[t, 0, 0] = 1.0
+        A[t, 1, 1] = 1.0
+        A[t, 2, 2] = 1.0
+        A[t, 3, 3] = 1.0
+        A[t, 0, 2] = structural(DT * cos_phi)
+        A[t, 0, 3] = structural(- DT * v * sin_phi)
+        A[t, 1, 2] = structural(DT * sin_phi)
+        A[t, 1, 3] = structural(DT * v * cos_phi)
+        A[t, 3, 2] = structural(DT * math.tan(delta) / WB)
+
+        B[t, 2, 0] = DT
+        B[t, 3, 1] = structural(DT * v / (WB * cos_delta2))
+
+        C[t, 0] = DT * v * sin_phi * phi
+        C[t, 1] = - DT * v * cos_phi * phi
+        C[t, 3] = - DT * v * delta / (WB * cos_delta2)
+
+def _car_shape():
     outline = np.array([[-BACKTOWHEEL, (LENGTH - BACKTOWHEEL), (LENGTH - BACKTOWHEEL), -BACKTOWHEEL, -BACKTOWHEEL],
                         [WIDTH / 2, WIDTH / 2, - WIDTH / 2, -WIDTH / 2, WIDTH / 2]])
 
@@ -517,64 +648,70 @@ def plot_car(x, y, yaw, steer=0.0, cabcolor="-r", truckcolor="-k"):  # pragma: n
     rl_wheel = np.copy(rr_wheel)
     rl_wheel[1, :] *= -1
 
-    Rot1 = np.array([[math.cos(yaw), math.sin(yaw)],
-                     [-math.sin(yaw), math.cos(yaw)]])
-    Rot2 = np.array([[math.cos(steer), math.sin(steer)],
-                     [-math.sin(steer), math.cos(steer)]])
-
-    fr_wheel = (fr_wheel.T.dot(Rot2)).T
-    fl_wheel = (fl_wheel.T.dot(Rot2)).T
-    fr_wheel[0, :] += WB
-    fl_wheel[0, :] += WB
-
-    fr_wheel = (fr_wheel.T.dot(Rot1)).T
-    fl_wheel = (fl_wheel.T.dot(Rot1)).T
-
-    outline = (outline.T.dot(Rot1)).T
-    rr_wheel = (rr_wheel.T.dot(Rot1)).T
-    rl_wheel = (rl_wheel.T.dot(Rot1)).T
-
-    outline[0, :] += x
-    outline[1, :] += y
-    fr_wheel[0, :] += x
-    fr_wheel[1, :] += y
-    rr_wheel[0, :] += x
-    rr_wheel[1, :] += y
-    fl_wheel[0, :] += x
-    fl_wheel[1, :] += y
-    rl_wheel[0, :] += x
-    rl_wheel[1, :] += y
-
-    plt.plot(np.array(outline[0, :]).flatten(),
-             np.array(outline[1, :]).flatten(), truckcolor)
-    plt.plot(np.array(fr_wheel[0, :]).flatten(),
-             np.array(fr_wheel[1, :]).flatten(), truckcolor)
-    plt.plot(np.array(rr_wheel[0, :]).flatten(),
-             np.array(rr_wheel[1, :]).flatten(), truckcolor)
-    plt.plot(np.array(fl_wheel[0, :]).flatten(),
-             np.array(fl_wheel[1, :]).flatten(), truckcolor)
-    plt.plot(np.array(rl_wheel[0, :]).flatten(),
-             np.array(rl_wheel[1, :]).flatten(), truckcolor)
-    plt.plot(x, y, "*")
+    return np.hstack([outline, fr_wheel, fl_wheel, rr_wheel, rl_wheel])
 
-def update_state(state, a, delta):
+# vehicle outline and the fr, fl, rr, rl wheels, 5 points each
+CAR_SHAPE = _car_shape()
+CAR_FRONT_WHEELS = slice(5, 15)
+
+def car_points(x, y, yaw, steer=0.0):
+    """
+    CAR_SHAPE (2, 25) moved to the pose (x, y, yaw), front wheels steered
+    """
+    pts = CAR_SHAPE.copy()
+
+    Rot2 = np.array([[math.cos(steer), -math.sin(steer)],
+                     [math.sin(steer), math.cos(steer)]])
+    pts[:, CAR_FRONT_WHEELS] = Rot2 @ pts[:, CAR_FRONT_WHEELS]
+    pts[0, CAR_FRONT_WHEELS] += WB
+
+    Rot1 = np.array([[math.cos(yaw), -math.sin(yaw)],
+                     [math.sin(yaw), math.cos(yaw)]])
+    pts = Rot1 @ pts
+    pts[0, :] += x
+    pts[1, :] += y
+    return pts
 
+class CarPlot:  # pragma: no cover
+    """
+    vehicle drawn as one persistent PolyCollection of the outline and the
+    wheels, its vertices are updated in place
+    """
+
+    def __init__(self, ax, truckcolor="k", animated=False):
+        self.body = PolyCollection(self.__polygons(car_points(0.0, 0.0, 0.0)), closed=True,
+                                   facecolors="none", edgecolors=truckcolor, animated=animated)
+        ax.add_collection(self.body, autolim=False)
+        self.center, = ax.plot([], [], "*", animated=animated)
+        self.artists = [self.body, self.center]
+
+    @staticmethod
+    def __polygons(pts):
+        # (2, 25) points of 5 closed shapes -> (5, 4, 2) polygon vertices
+        return pts.T.reshape(-1, 5, 2)[:, :4]
+
+    def update(self, x, y, yaw, steer=0.0):
+        self.body.set_verts(self.__polygons(car_points(x, y, yaw, steer)))
+        self.center.set_data([x], [y])
+
+@njit(cache=True, fastmath=True)
+def motion_step(x, y, yaw, v, a, delta):
+    """
+    one DT step of the kinematic bicycle model, steer and speed are clamped
+    """
     # input check
-    if delta >= MAX_STEER:
-        delta = MAX_STEER
-    elif delta <= -MAX_STEER:
-        delta = -MAX_STEER
+    delta = min(max(delta, -MAX_STEER), MAX_STEER)
 
-    state.x = state.x + state.v * math.cos(state.yaw) * DT
-    state.y = state.y + state.v * math.sin(state.yaw) * DT
-    state.yaw = state.yaw + state.v / WB * math.tan(delta) * DT
-    state.v = state.v + a * DT
+    x = x + v * math.cos(yaw) * DT
+    y = y + v * math.sin(yaw) * DT
+    yaw = yaw + v / WB * math.tan(delta) * DT
+    v = min(max(v + a * DT, MIN_SPEED), MAX_SPEED)
 
-    if state.v > MAX_SPEED:
-        state.v = MAX_SPEED
-    elif state.v < MIN_SPEED:
-        state.v = MIN_SPEED
+    return x, y, yaw, v
 
+def update_state(state, a, delta):
+    state.x, state.y, state.yaw, state.v = motion_step(
+        state.x, state.y, state.yaw, state.v, a, delta)
     return state
 
 def update_state_carla(state, easting, northing, yaw_radians_lib, speed):
@@ -597,244 +734,194 @@ def update_state_carla(state, easting, northing, yaw_radians_lib, speed):
 
     return state
 
-def get_nparray_from_matrix(x):
-    return np.array(x).flatten()
-
-def calc_nearest_index(state, cx, cy, cyaw, pind):
-
-    dx = [state.x - icx for icx in cx[pind:(pind + N_IND_SEARCH)]]
-    dy = [state.y - icy for icy in cy[pind:(pind + N_IND_SEARCH)]]
-
-    d = [idx ** 2 + idy ** 2 for (idx, idy) in zip(dx, dy)]
-
-    mind = min(d)
-
-    ind = d.index(mind) + pind
-
-    mind = math.sqrt(mind)
-
-    dxl = cx[ind] - state.x
-    dyl = cy[ind] - state.y
-
-    angle = pi_2_pi(cyaw[ind] - math.atan2(dyl, dxl))
+@njit(cache=True, fastmath=True)
+def nearest_course_index(x, y, xy, pind):
+    """
+    nearest of the N_IND_SEARCH course points from pind and its signed distance
+    xy: (N, 5) course array, columns cx, cy, cyaw, ...
+    """
+    ind = pind
+    dmin = np.inf
+    for i in range(pind, min(pind + N_IND_SEARCH, xy.shape[0])):
+        dx = xy[i, 0] - x
+        dy = xy[i, 1] - y
+        d = dx * dx + dy * dy
+        if d < dmin:
+            dmin = d
+            ind = i
+
+    mind = math.sqrt(dmin)
+
+    dx = xy[ind, 0] - x
+    dy = xy[ind, 1] - y
+    angle = pi_2_pi(xy[ind, 2] - math.atan2(dy, dx))
     if angle < 0:
         mind *= -1
 
     return ind, mind
 
-def predict_motion(x0, oa, od, xref):
-    xbar = xref * 0.0
-    for i, _ in enumerate(x0):
-        xbar[i, 0] = x0[i]
-
-    state = State(x=x0[0], y=x0[1], yaw=x0[3], v=x0[2])
-    for (ai, di, i) in zip(oa, od, range(1, T + 1)):
-        state = update_state(state, ai, di)
-        xbar[0, i] = state.x
-        xbar[1, i] = state.y
-        xbar[2, i] = state.v
-        xbar[3, i] = state.yaw
-
-    return xbar
+def calc_nearest_index(state, course, pind):
+    return nearest_course_index(state.x, state.y, course.xy, pind)
 
-def iterative_linear_mpc_control(xref, x0, dref, oa, od):
+@njit(cache=True, fastmath=True)
+def predict_motion(x0, oa, od, xbar):
     """
-    MPC control with updating operational point iteratively
+    roll out the motion model from x0 = [x, y, v, yaw] with the inputs
+    (oa, od) and write the operational points into xbar (NX, T + 1)
     """
-    ox, oy, oyaw, ov = None, None, None, None
+    x, y, v, yaw = x0[0], x0[1], x0[2], x0[3]
+    xbar[0, 0] = x
+    xbar[1, 0] = y
+    xbar[2, 0] = v
+    xbar[3, 0] = yaw
 
-    if oa is None or od is None:
-        oa = [0.0] * T
-        od = [0.0] * T
-
-    for i in range(MAX_ITER):
-        xbar = predict_motion(x0, oa, od, xref)
-        poa, pod = oa[:], od[:]
-        oa, od, ox, oy, oyaw, ov = linear_mpc_control(xref, xbar, x0, dref)
-        du = sum(abs(oa - poa)) + sum(abs(od - pod))  # calc u change value
-        if du <= DU_TH:
-            break
-    else:
-        print("Iterative is max iter")
+    for i in range(T):
+        x, y, yaw, v = motion_step(x, y, yaw, v, oa[i], od[i])
 
-    return oa, od, ox, oy, oyaw, ov
+        xbar[0, i + 1] = x
+        xbar[1, i + 1] = y
+        xbar[2, i + 1] = v
+        xbar[3, i + 1] = yaw
 
-def linear_mpc_control(xref, xbar, x0, dref):
-    """
-    linear mpc control
-
-    xref: reference point
-    xbar: operational point
-    x0: initial state
-    dref: reference steer angle
-    """
-
-    x = cvxpy.Variable((NX, T + 1))
-    u = cvxpy.Variable((NU, T))
-
-    cost = 0.0
-    constraints = []
-
-    for t in range(T):
-        cost += cvxpy.quad_form(u[:, t], R)
-
-        if t != 0:
-            cost += cvxpy.quad_form(xref[:, t] - x[:, t], Q)
-
-        A, B, C = get_linear_model_matrix(
-            xbar[2, t], xbar[3, t], dref[0, t])
-        constraints += [x[:, t + 1] == A @ x[:, t] + B @ u[:, t] + C]
-
-        if t < (T - 1):
-            cost += cvxpy.quad_form(u[:, t + 1] - u[:, t], Rd)
-            constraints += [cvxpy.abs(u[1, t + 1] - u[1, t]) <=
-                            MAX_DSTEER * DT]
-
-    cost += cvxpy.quad_form(xref[:, T] - x[:, T], Qf)
-
-    constraints += [x[:, 0] == x0]
-    constraints += [x[2, :] <= MAX_SPEED]
-    constraints += [x[2, :] >= MIN_SPEED]
-    constraints += [cvxpy.abs(u[0, :]) <= MAX_ACCEL]
-    constraints += [cvxpy.abs(u[1, :]) <= MAX_STEER]
-
-    prob = cvxpy.Problem(cvxpy.Minimize(cost), constraints)
-    prob.solve(solver=cvxpy.CLARABEL, verbose=False)
-
-    if prob.status == cvxpy.OPTIMAL or prob.status == cvxpy.OPTIMAL_INACCURATE:
-        ox = get_nparray_from_matrix(x.value[0, :])
-        oy = get_nparray_from_matrix(x.value[1, :])
-        ov = get_nparray_from_matrix(x.value[2, :])
-        oyaw = get_nparray_from_matrix(x.value[3, :])
-        oa = get_nparray_from_matrix(u.value[0, :])
-        odelta = get_nparray_from_matrix(u.value[1, :])
-
-    else:
-        print("Error: Cannot solve mpc..")
-        oa, odelta, ox, oy, oyaw, ov = None, None, None, None, None, None
+    return xbar
 
-    return oa, odelta, ox, oy, oyaw, ov
+# horizon constants of calc_ref_trajectory, dref is shared and read only
+HORIZON_STEPS = np.arange(T + 1)
+DREF = np.zeros((1, T + 1))  # steer operational point should be 0
+DREF.flags.writeable = False
 
-def calc_ref_trajectory(state, cx, cy, cyaw, ck, sp, dl, pind):
-    xref = np.zeros((NX, T + 1))
-    dref = np.zeros((1, T + 1))
-    ncourse = len(cx)
+def calc_ref_trajectory(state, course, pind):
+    xref = np.empty((NX, T + 1))
+    ncourse = len(course.xy)
 
-    ind, _ = calc_nearest_index(state, cx, cy, cyaw, pind)
+    ind, _ = nearest_course_index(state.x, state.y, course.xy, pind)
 
     if pind >= ind:
         ind = pind
 
-    xref[0, 0] = cx[ind]
-    xref[1, 0] = cy[ind]
-    xref[2, 0] = sp[ind]
-    xref[3, 0] = cyaw[ind]
-    dref[0, 0] = 0.0  # steer operational point should be 0
+    # the course points travelled at the current speed over the horizon
+    travel = HORIZON_STEPS * (abs(state.v) * DT)
+    dind = np.rint(travel / course.dl).astype(np.int64)
+    rows = np.minimum(ind + dind, ncourse - 1)
 
-    travel = 0.0
+    xref[:, :] = course.xy[rows[:, None], COURSE_XREF].T
 
-    for i in range(T + 1):
-        travel += abs(state.v) * DT
-        dind = int(round(travel / dl))
+    return xref, ind, DREF
 
-        if (ind + dind) < ncourse:
-            xref[0, i] = cx[ind + dind]
-            xref[1, i] = cy[ind + dind]
-            xref[2, i] = sp[ind + dind]
-            xref[3, i] = cyaw[ind + dind]
-            dref[0, i] = 0.0
-        else:
-            xref[0, i] = cx[ncourse - 1]
-            xref[1, i] = cy[ncourse - 1]
-            xref[2, i] = sp[ncourse - 1]
-            xref[3, i] = cyaw[ncourse - 1]
-            dref[0, i] = 0.0
+def shift_inputs(oa, od, n=1):
+    """
+    shift the last input sequences n steps ahead, repeating the last input
+    seeds the operating point of the next solve
+    """
+    if oa is None or od is None:
+        return None, None
+    return (np.concatenate((oa[n:], np.repeat(oa[-1], n))),
+            np.concatenate((od[n:], np.repeat(od[-1], n))))
 
-    return xref, ind, dref
 
-def check_goal(state, goal, tind, nind):
+@njit(cache=True, fastmath=True)
+def goal_reached(x, y, v, gx, gy, tind, nind):
 
     # check goal
-    dx = state.x - goal[0]
-    dy = state.y - goal[1]
+    dx = x - gx
+    dy = y - gy
     d = math.hypot(dx, dy)
 
-    isgoal = (d <= GOAL_DIS or any(x < 0 for x in [dx,dy]))
+    isgoal = (d <= GOAL_DIS or dx < 0 or dy < 0)
 
     if abs(tind - nind) >= 5:
         isgoal = False
 
-    isstop = (abs(state.v) <= STOP_SPEED)
+    isstop = (abs(v) <= STOP_SPEED)
 
-    if isgoal and isstop:
-        return True
+    return isgoal and isstop
 
-    return False
+def check_goal(state, goal, tind, nind):
+    return goal_reached(state.x, state.y, state.v, goal[0], goal[1], tind, nind)
 
 def calc_speed_profile(cx, cy, cyaw, target_speed):
 
-    speed_profile = [target_speed] * len(cx)
-    direction = 1.0  # forward
+    cx = np.asarray(cx, dtype=np.float64)
+    cy = np.asarray(cy, dtype=np.float64)
+    cyaw = np.asarray(cyaw, dtype=np.float64)
 
-    # Set stop point
-    for i in range(len(cx) - 1):
-        dx = cx[i + 1] - cx[i]
-        dy = cy[i + 1] - cy[i]
+    speed_profile = np.full(len(cx), target_speed, dtype=np.float64)
 
-        move_direction = math.atan2(dy, dx)
+    dx = np.diff(cx)
+    dy = np.diff(cy)
 
-        if dx != 0.0 and dy != 0.0:
-            dangle = abs(pi_2_pi(move_direction - cyaw[i]))
-            if dangle >= math.pi / 4.0:
-                direction = -1.0
-            else:
-                direction = 1.0
+    move_direction = np.arctan2(dy, dx)
+    dangle = np.abs(angle_mod(move_direction - cyaw[:-1]))
 
-        if direction != 1.0:
-            speed_profile[i] = - target_speed
-        else:
-            speed_profile[i] = target_speed
+    # the direction is only updated where dx and dy are both nonzero,
+    # in between the last one is kept (forward at start)
+    update = (dx != 0.0) & (dy != 0.0)
+    last = np.maximum.accumulate(np.where(update, np.arange(len(dx)), -1))
+    backward = (last >= 0) & (dangle[last] >= math.pi / 4.0)
 
+    # Set stop point
+    speed_profile[:-1][backward] = - target_speed
     speed_profile[-1] = 0.0
 
     return speed_profile
 
 def smooth_yaw(yaw):
-
-    for i in range(len(yaw) - 1):
-        dyaw = yaw[i + 1] - yaw[i]
-
-        while dyaw >= math.pi / 2.0:
-            yaw[i + 1] -= math.pi * 2.0
-            dyaw = yaw[i + 1] - yaw[i]
-
-        while dyaw <= -math.pi / 2.0:
-            yaw[i + 1] += math.pi * 2.0
-            dyaw = yaw[i + 1] - yaw[i]
-
-    return yaw
+    """
+    unwrap the yaw jumps of the course, returns a new array
+    a step larger than pi is moved by multiples of 2 pi to within pi,
+    np.unwrap does not take a threshold below pi
+    """
+    return np.unwrap(np.asarray(yaw, dtype=np.float64))
 
 def load_arrays_from_file():
-    arrays = []
     filename='/workspace/src/control/src/ws_mpc/odm_x_y_yaw_abs_log_7_straight.txt'
-    with open(filename, 'r') as f:
-        for line in f:
-            x, y = map(float, line.strip().split(','))
-            arrays.append(np.array([x, y]))
-    return arrays
+    return np.loadtxt(filename, delimiter=',', dtype=np.float64, ndmin=2)
 
 def reformatting(path):
-    path_array = np.array(path) 
-    ax = path_array[:,0].tolist()
-    ay = path_array[:,1].tolist()
+    path_array = np.asarray(path, dtype=np.float64)
+    ax = path_array[:, 0]
+    ay = path_array[:, 1]
     return ax, ay 
 
-def get_path(waypoints, dl=1):
+def get_path(waypoints, dl=1, target_speed=TARGET_SPEED):
+    """
+    spline course with its speed profile as one (N, 5) array,
+    columns cx, cy, cyaw, ck, sp
+    """
     ax, ay = reformatting(waypoints)
     cx, cy, cyaw, ck, s = calc_spline_course(
         ax, ay, ds=dl)
+    sp = calc_speed_profile(cx, cy, cyaw, target_speed)
+
+    course = np.empty((len(cx), 5), dtype=np.float64)
+    course[:, 0] = cx
+    course[:, 1] = cy
+    course[:, 2] = cyaw
+    course[:, 3] = ck
+    course[:, 4] = sp
+    return course
+
+@dataclass
+class Course:
+    """
+    course precomputed once for the mpc
+
+    xy: (N, 5) array of cx, cy, cyaw (unwrapped), ck, sp
+    goal: (2,) last course point
+    dl: course tick [m]
+    """
+    xy: np.ndarray
+    goal: np.ndarray
+    dl: float
+
+    def __post_init__(self):
+        # the nearest index search is compiled for contiguous float64 courses
+        self.xy = np.ascontiguousarray(self.xy, dtype=np.float64)
 
-    return cx, cy, cyaw, ck
+def build_course(waypoints, dl=1, target_speed=TARGET_SPEED):
+    xy = get_path(waypoints, dl, target_speed)
+    xy[:, 2] = smooth_yaw(xy[:, 2])
+    return Course(xy, xy[-1, :2].copy(), dl)
 
 def angle_norm(yaw_angle):
     """
@@ -886,12 +973,10 @@ def set_mpc_option():
     dl = 1.0  # course tick
     waypoints = load_arrays_from_file()
 
-    ### local path planning -> spline generation
-    cx, cy, cyaw, ck = get_path(waypoints, dl)
-    ### speed profile for mpc
-    sp = calc_speed_profile(cx, cy, cyaw, TARGET_SPEED)
+    ### local path planning -> spline generation with speed profile for mpc
+    course = build_course(waypoints, dl, TARGET_SPEED)
     initial_state = State(x=lat, y=lon, yaw=yaw, v=speed)
-    options = [cx, cy, cyaw, ck, sp, dl, initial_state, lat, lon, yaw, speed]
+    options = [course, initial_state, lat, lon, yaw, speed]
     return options, getinfo
 
 class Control2Carla:
@@ -899,28 +984,32 @@ class Control2Carla:
         vehicle = VehicleConfig(platform)
         self.ego_vehicle_controller = Ctrl_CV_CarlaEgoVehicelControl(vehicle.vehicle_config['Ego_Control'])
 
-        # Create PID controllers for throttle, brake, and steering
-        # Only P control is used (Ki and Kd are set to 0)
-        self.throttle_pid = PID(Kp=10, Ki=0, Kd=0, setpoint=0, output_limits=(0, 1))
-        self.brake_pid = PID(Kp=10, Ki=0, Kd=0, setpoint=0, output_limits=(0, 1))
-        self.steering_pid = PID(Kp=10, Ki=0, Kd=0, setpoint=0, output_limits=(-1, 1))
+        # Setpoints of the throttle, brake and steering controllers
+        # Only P control is used, output = clip(Kp * (setpoint - input))
+        self.kp = 10.0
+        self._ts = 0.0
+        self._bs = 0.0
+        self._ss = 0.0
 
     # Function to update control outputs
     def update_controls(self, throttle_input, brake_input, steering_input):
         # Calculate control outputs
-        throttle_output = self.throttle_pid(throttle_input)
-        brake_output = self.brake_pid(brake_input)
-        steering_output = self.steering_pid(steering_input)
-        
+        throttle_output = min(max(self.kp * (self._ts - throttle_input), 0.0), 1.0)
+        brake_output = min(max(self.kp * (self._bs - brake_input), 0.0), 1.0)
+        steering_output = min(max(self.kp * (self._ss - steering_input), -1.0), 1.0)
+
         return round(throttle_output,2), round(brake_output,2), round(steering_output,2),
 
     # def pid_scratch(self,):
 
 class MPC_Controller():
-    def __init__(self, initial_state, isPlot = False) -> None:
+    def __init__(self, initial_state, isPlot = False, solver_name = None) -> None:
         self.isRuningMPC = False
         self.isPlot = isPlot        
         self.state = initial_state
+        if solver_name is None:
+            solver_name = 'CPG' if cpg_solve is not None else cvxpy.OSQP
+        self.solver_name = solver_name  # qp solver of the mpc, CLARABEL is the fallback
 
         self.control2carla = Control2Carla('carla')
 
@@ -934,13 +1023,187 @@ class MPC_Controller():
             'manual_gear_shift': False
         }
 
+        self._build_mpc()
+
+    def _build_mpc(self):
+        """
+        build the parametric mpc problem once
+
+        xref, x0 and the linearized model (A, B, C) of every step are
+        cvxpy Parameters, so each tick only updates their values and the
+        problem is not canonicalized again.
+        The decision variable z interleaves the stages, [x0, u0, x1, u1, ..., xT],
+        and the cost is a constant quadratic form of z plus a term linear in
+        xref, so the qp holds only the stage variables and its KKT matrix is
+        block banded. The quadratic form is kept over sum_squares of scaled
+        slices of z, cvxpy adds an auxiliary variable for every such slice,
+        which doubles the qp (72 instead of 34 variables).
+        Bounds are written as two sided rows instead of abs.
+        """
+        nz = T * (NX + NU) + NX
+        # indices of x_t and u_t in z, columns are the stages
+        self._x_idx = np.arange(NX)[:, None] + (NX + NU) * np.arange(T + 1)
+        self._u_idx = NX + np.arange(NU)[:, None] + (NX + NU) * np.arange(T)
+
+        self.z = cvxpy.Variable(nz, name='z')
+        self.P_xref = cvxpy.Parameter((NX, T + 1), name='xref')
+        self.P_x0 = cvxpy.Parameter(NX, name='x0')
+        # linearized models of all steps stacked row wise, step t is rows t * NX
+        self.P_A = cvxpy.Parameter((T * NX, NX), name='A')
+        self.P_B = cvxpy.Parameter((T * NX, NU), name='B')
+        self.P_C = cvxpy.Parameter((T, NX), name='C')
+        # linearized model of every step, filled in place each solve
+        self._A_buf = np.zeros((T, NX, NX))
+        self._B_buf = np.zeros((T, NX, NU))
+        self._C_buf = np.zeros((T, NX))
+        self._xbar = np.zeros((NX, T + 1))  # operational point
+
+        z, xref = self.z, self.P_xref
+        xs = [slice(i, i + NX) for i in self._x_idx[0]]
+        us = [slice(i, i + NU) for i in self._u_idx[0]]
+
+        # (xref - x)' Q (xref - x) = x' Q x - 2 (Q xref)' x + const
+        H = np.zeros((nz, nz))
+        cost = 0.0
+        constraints = []
+
+        for t in range(T):
+            H[us[t], us[t]] += R
+
+            if t != 0:
+                H[xs[t], xs[t]] += Q
+                cost += -2.0 * (Q @ xref[:, t]) @ z[xs[t]]
+
+            rows = slice(t * NX, (t + 1) * NX)
+            constraints += [z[xs[t + 1]] == self.P_A[rows, :] @ z[xs[t]]
+                            + self.P_B[rows, :] @ z[us[t]] + self.P_C[t, :]]
+
+            if t < (T - 1):
+                H[us[t], us[t]] += Rd
+                H[us[t + 1], us[t + 1]] += Rd
+                H[us[t], us[t + 1]] -= Rd
+                H[us[t + 1], us[t]] -= Rd
+                dsteer = z[us[t + 1].start + 1] - z[us[t].start + 1]
+                constraints += [dsteer <= MAX_DSTEER * DT,
+                                dsteer >= -MAX_DSTEER * DT]
+
+        H[xs[T], xs[T]] += Qf
+        cost += -2.0 * (Qf @ xref[:, T]) @ z[xs[T]]
+        cost += cvxpy.quad_form(z, H)
+
+        v = z[self._x_idx[2]]
+        accel = z[self._u_idx[0]]
+        steer = z[self._u_idx[1]]
+        constraints += [z[xs[0]] == self.P_x0]
+        constraints += [v <= MAX_SPEED, v >= MIN_SPEED]
+        constraints += [accel <= MAX_ACCEL, accel >= -MAX_ACCEL]
+        constraints += [steer <= MAX_STEER, steer >= -MAX_STEER]
+
+        self.prob = cvxpy.Problem(cvxpy.Minimize(cost), constraints)
+        self._warm = False  # the OSQP workspace of the last solve can be reused
+        if cpg_solve is not None:
+            self.prob.register_solve('CPG', cpg_solve)
+
+    def _solve(self, warm_start=True):
+        """
+        solve the cached mpc problem with self.solver_name
+
+        the qp is tiny and re-solved every tick, so OSQP is warm started from
+        the previous solution with loose tolerances. CLARABEL is tried once
+        when the first solver fails. Return True if the problem is solved.
+        """
+        prob = self.prob
+        solved = False
+        try:
+            if self.solver_name == 'CPG':
+                # the generated solver reports the status of OSQP itself
+                prob.solve(method='CPG', warm_start=True, eps_abs=1e-3, eps_rel=1e-3, max_iter=4000)
+                solved = prob.status in ('solved', 'solved inaccurate')
+            else:
+                if self.solver_name == cvxpy.OSQP:
+                    prob.solve(solver=cvxpy.OSQP, warm_start=warm_start, verbose=False,
+                               eps_abs=1e-3, eps_rel=1e-3, max_iter=4000, **{OSQP_POLISH: False})
+                else:
+                    prob.solve(solver=self.solver_name, warm_start=warm_start, verbose=False)
+                solved = prob.status in (cvxpy.OPTIMAL, cvxpy.OPTIMAL_INACCURATE)
+        except cvxpy.error.SolverError:
+            pass
+
+        if not solved and self.solver_name != cvxpy.CLARABEL:
+            prob.solve(solver=cvxpy.CLARABEL, verbose=False)
+            solved = prob.status in (cvxpy.OPTIMAL, cvxpy.OPTIMAL_INACCURATE)
+
+        return solved
+
+    def iterative_linear_mpc_control(self, xref, x0, dref, oa, od):
+        """
+        MPC control with updating operational point iteratively
+        """
+        ox, oy, oyaw, ov = None, None, None, None
+
+        if oa is None or od is None:
+            oa = np.zeros(T)
+            od = np.zeros(T)
+        x0 = np.asarray(x0, dtype=np.float64)
+
+        pxbar = None
+        for i in range(MAX_ITER):
+            xbar = predict_motion(x0, oa, od, self._xbar)
+            # the last solution moved the operating point only slightly
+            if pxbar is not None and np.max(np.abs(xbar - pxbar)) <= DX_TH:
+                break
+            pxbar = xbar.copy()
+            poa, pod = oa[:], od[:]
+            oa, od, ox, oy, oyaw, ov = self.linear_mpc_control(xref, xbar, x0, dref)
+            if oa is None:
+                break
+            du = sum(abs(oa - poa)) + sum(abs(od - pod))  # calc u change value
+            if du <= DU_TH:
+                break
+        else:
+            print("Iterative is max iter")
+
+        return oa, od, ox, oy, oyaw, ov
+
+    def linear_mpc_control(self, xref, xbar, x0, dref):
+        """
+        linear mpc control
+
+        xref: reference point
+        xbar: operational point
+        x0: initial state
+        dref: reference steer angle
+        """
+        self.P_xref.value = xref
+        self.P_x0.value = np.asarray(x0)
+
+        build_linear_model_batch(xbar, dref, self._A_buf, self._B_buf, self._C_buf)
+        self.P_A.value = self._A_buf.reshape(T * NX, NX)
+        self.P_B.value = self._B_buf.reshape(T * NX, NU)
+        self.P_C.value = self._C_buf
+
+        # structural() keeps the nonzero pattern of A, B fixed, so the cached
+        # OSQP workspace only needs its values updated after the first setup
+        if self._solve(self._warm):
+            self._warm = True
+            z = self.z.value
+            ox, oy, ov, oyaw = z[self._x_idx]
+            oa, odelta = z[self._u_idx]
+
+        else:
+            print("Error: Cannot solve mpc..")
+            self._warm = False
+            oa, odelta, ox, oy, oyaw, ov = None, None, None, None, None, None
+
+        return oa, odelta, ox, oy, oyaw, ov
+
     def pub_msg(self, control_dict):
         self.control2carla.ego_vehicle_controller.pub_control_msg(control_dict)
 
     def update_pid_setpoint(self, throttle, brake, steering_norm):
-        self.control2carla.throttle_pid.setpoint = throttle
-        self.control2carla.brake_pid.setpoint = brake
-        self.control2carla.steering_pid.setpoint = steering_norm
+        self.control2carla._ts = throttle
+        self.control2carla._bs = brake
+        self.control2carla._ss = steering_norm
 
     def update_control_dict(self, di, ai, throttle_current, brake_current, steering_current):
 
@@ -973,43 +1236,53 @@ class MPC_Controller():
         """
         Simulation
         Modified: Li Xingyou
-        cx: course x position list (any)
-        cy: course y position list (any)
-        cyaw: course yaw position list (radian)
-        ck: course curvature list
-        sp: speed profile
-        dl: course tick [m]
+        course: Course, course.xy is the (N, 5) array of cx, cy, cyaw, ck, sp
+            cx, cy: course x, y position
+            cyaw: course yaw position (radian)
+            ck: course curvature
+            sp: speed profile
+            course.dl: course tick [m]
 
         """
-        cx, cy, cyaw, ck, sp, dl, _, lat, lon, yaw, speed = options
+        course, _, lat, lon, yaw, speed = options
 
         # initial yaw compensation
-        if self.state.yaw - cyaw[0] >= math.pi:
+        if self.state.yaw - course.xy[0, 2] >= math.pi:
             self.state.yaw -= math.pi * 2.0
-        elif self.state.yaw - cyaw[0] <= -math.pi:
+        elif self.state.yaw - course.xy[0, 2] <= -math.pi:
             self.state.yaw += math.pi * 2.0
-        cyaw = smooth_yaw(cyaw)
 
         time = 0.0
-        target_ind, _ = calc_nearest_index(self.state, cx, cy, cyaw, 0)
+        target_ind, _ = calc_nearest_index(self.state, course, 0)
         odelta, oa = None, None
-        goal = [cx[-1], cy[-1]]
+        t_solve = None  # ros time of the last mpc solve
+        goal = course.goal
         self.isRuningMPC = True
         while self.isRuningMPC:
             infos = getinfo.run()
             lat, lon, yaw, speed, throttle, brake, steering = infos
 
-            xref, target_ind, dref = calc_ref_trajectory(
-                self.state, cx, cy, cyaw, ck, sp, dl, target_ind)
+            # a tick is one odometry message, not one DT, so the solved horizon
+            # is indexed by the time elapsed since its solve. The mpc is solved
+            # again once MPC_DECIMATION steps of it have passed
+            # (1e-6 keeps a stamp exactly DT apart from rounding down)
+            now = rospy.get_time()
+            j = MPC_DECIMATION if t_solve is None else int((now - t_solve) / DT + 1e-6)
+            target_ind, _ = calc_nearest_index(self.state, course, target_ind)
+            if odelta is None or j >= MPC_DECIMATION:
+                xref, target_ind, dref = calc_ref_trajectory(
+                    self.state, course, target_ind)
 
-            x0 = [self.state.x, self.state.y, self.state.v, self.state.yaw]  # current state
+                x0 = self.state.vec.copy()  # current state
 
-            oa, odelta, ox, oy, oyaw, ov = iterative_linear_mpc_control(
-                xref, x0, dref, oa, odelta)
+                oa, odelta = shift_inputs(oa, odelta, min(j, T))
+                oa, odelta, ox, oy, oyaw, ov = self.iterative_linear_mpc_control(
+                    xref, x0, dref, oa, odelta)
+                t_solve, j = now, 0
 
             di, ai = 0.0, 0.0
             if odelta is not None:
-                di, ai = odelta[0], oa[0] # delta is steering, a is accelerate
+                di, ai = odelta[j], oa[j] # delta is steering, a is accelerate
 
                 self.state = update_state_carla(self.state, lat, lon, yaw, speed)
             else:
@@ -1021,7 +1294,7 @@ class MPC_Controller():
             self.pub_msg(control_data)
 
             # Break the loop if goal is reached
-            if check_goal(self.state, goal, target_ind, len(cx)) or MAX_TIME < time:
+            if check_goal(self.state, goal, target_ind, len(course.xy)) or MAX_TIME < time:
                 print("Goal reached")
                 break
 
@@ -1032,47 +1305,55 @@ class MPC_Controller():
         """
         Simulation
 
-        cx: course x position list
-        cy: course y position list
-        cy: course yaw position list
-        ck: course curvature list
-        sp: speed profile
-        dl: course tick [m]
+        course: Course, course.xy is the (N, 5) array of cx, cy, cyaw, ck, sp
+            cx, cy: course x, y position
+            cyaw: course yaw position
+            ck: course curvature
+            sp: speed profile
+            course.dl: course tick [m]
 
         """
-        cx, cy, cyaw, ck, sp, dl, _, _, _, _, _ = options
+        course, _, _, _, _, _ = options
 
-        goal = [cx[-1], cy[-1]]
+        goal = course.goal
 
         state = self.state
 
         # initial yaw compensation
-        if state.yaw - cyaw[0] >= math.pi:
+        if state.yaw - course.xy[0, 2] >= math.pi:
             state.yaw -= math.pi * 2.0
-        elif state.yaw - cyaw[0] <= -math.pi:
+        elif state.yaw - course.xy[0, 2] <= -math.pi:
             state.yaw += math.pi * 2.0
 
         time = 0.0
-        x = [state.x]
-        y = [state.y]
-        yaw = [state.yaw]
-        v = [state.v]
-        t = [0.0]
-        d = [0.0]
-        a = [0.0]
-        target_ind, _ = calc_nearest_index(state, cx, cy, cyaw, 0)
+        # log rows of t, x, y, yaw, v, d, a, one per tick,
+        # with a spare row for the rounding of the accumulated time
+        log = np.empty((int(MAX_TIME / DT) + 3, 7))
+        log[0] = (0.0, state.x, state.y, state.yaw, state.v, 0.0, 0.0)
+        k = 0  # last log row
+        target_ind, _ = calc_nearest_index(state, course, 0)
 
         odelta, oa = None, None
 
-        cyaw = smooth_yaw(cyaw)
-
+        if show_animation:  # pragma: no cover
+            # rendered in its own process, frames are dropped while it is busy
+            frames = multiprocessing.Queue(maxsize=1)
+            stop = multiprocessing.Event()
+            renderer = multiprocessing.Process(
+                target=animation_process, args=(course.xy, frames, stop), daemon=True)
+            renderer.start()
+            sent = 0  # log rows already sent to the renderer
+            rendering = True  # False once the renderer has exited
+
+        step = 0
         while MAX_TIME >= time:
             xref, target_ind, dref = calc_ref_trajectory(
-                state, cx, cy, cyaw, ck, sp, dl, target_ind)
+                state, course, target_ind)
 
-            x0 = [state.x, state.y, state.v, state.yaw]  # current state
+            x0 = state.vec.copy()  # current state
 
-            oa, odelta, ox, oy, oyaw, ov = iterative_linear_mpc_control(
+            oa, odelta = shift_inputs(oa, odelta)
+            oa, odelta, ox, oy, oyaw, ov = self.iterative_linear_mpc_control(
                 xref, x0, dref, oa, odelta)
 
             di, ai = 0.0, 0.0
@@ -1082,40 +1363,119 @@ class MPC_Controller():
 
             time = time + DT
 
-            x.append(state.x)
-            y.append(state.y)
-            yaw.append(state.yaw)
-            v.append(state.v)
-            t.append(time)
-            d.append(di)
-            a.append(ai)
+            k += 1
+            log[k] = (time, state.x, state.y, state.yaw, state.v, di, ai)
 
-            if check_goal(state, goal, target_ind, len(cx)):
+            if check_goal(state, goal, target_ind, len(course.xy)):
                 print("Goal")
                 break
 
-            if show_animation:  # pragma: no cover
-                plt.cla()
+            if show_animation and step % animation_step == 0:  # pragma: no cover
                 # for stopping simulation with the esc key.
-                plt.gcf().canvas.mpl_connect('key_release_event',
-                        lambda event: [exit(0) if event.key == 'escape' else None])
-                if ox is not None:
-                    plt.plot(ox, oy, "xr", label="MPC")
-                plt.plot(cx, cy, "-r", label="course")
-                plt.plot(x, y, "ob", label="trajectory")
-                plt.plot(xref[0, :], xref[1, :], "xk", label="xref")
-                plt.plot(cx[target_ind], cy[target_ind], "xg", label="target")
-                plot_car(state.x, state.y, state.yaw, steer=di)
-                plt.axis("equal")
-                plt.grid(True)
-                plt.title("Time[s]:" + str(round(time, 2))
-                        + ", speed[km/h]:" + str(round(state.v * 3.6, 2))
-                        + ", acc[m/s^2]:" + str(round(ai, 2))
-                        + ", steering[rad]:" + str(round(di, 2)))
-                plt.pause(0.0001)
-
+                if stop.is_set():
+                    break
+                if rendering and not renderer.is_alive():
+                    # e.g. no display, the simulation goes on without it
+                    print("Animation process exited, frames are no longer sent")
+                    rendering = False
+                if rendering:
+                    try:
+                        frames.put_nowait((log[sent:k + 1].copy(), xref, ox, oy, target_ind))
+                        sent = k + 1
+                    except queue.Full:
+                        pass  # the unsent rows go with the next frame
+            step += 1
+
+        if show_animation:  # pragma: no cover
+            # bounded, a renderer that died leaves its last frame unread
+            if renderer.is_alive():
+                try:
+                    frames.put(None, timeout=1.0)
+                except queue.Full:
+                    pass
+            renderer.join(timeout=5.0)
+            if renderer.is_alive():
+                renderer.terminate()
+            # do not wait at exit to flush frames nobody will read
+            frames.cancel_join_thread()
+
+        t, x, y, yaw, v, d, a = log[:k + 1].T
         return t, x, y, yaw, v, d, a
 
+def animation_process(course_xy, frames, stop):  # pragma: no cover
+    """
+    draw the do_simulation animation, run in a process of its own
+
+    course_xy: (N, 5) course array
+    frames: queue of (log rows since the last frame, xref, ox, oy, target_ind),
+        None closes the animation
+    stop: event set by the esc key
+    """
+    # static course drawn once into a cached background,
+    # the animated artists are blitted on top of it every frame
+    fig, ax = plt.subplots()
+    fig.canvas.mpl_connect('key_release_event',
+            lambda event: stop.set() if event.key == 'escape' else None)
+    mpc_line, = ax.plot([], [], "xr", label="MPC", animated=True)
+    ax.plot(course_xy[:, 0], course_xy[:, 1], "-r", label="course")
+    traj_line, = ax.plot([], [], "ob", label="trajectory", animated=True)
+    xref_line, = ax.plot([], [], "xk", label="xref", animated=True)
+    target_line, = ax.plot([], [], "xg", label="target", animated=True)
+    car_plot = CarPlot(ax, animated=True)
+    title = ax.text(0.5, 1.01, "", transform=ax.transAxes, ha="center", animated=True)
+    artists = [mpc_line, traj_line, xref_line, target_line, title] + car_plot.artists
+    # the view is fixed by the course, blitted artists do not autoscale
+    ax.axis("equal")
+    ax.grid(True)
+
+    background = None
+
+    def grab_background(event):
+        # a full redraw (e.g. resize) invalidates the cached background
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+        for artist in artists:
+            ax.draw_artist(artist)
+
+    fig.canvas.mpl_connect('draw_event', grab_background)
+    plt.show(block=False)
+    plt.pause(0.1)
+
+    traj_x, traj_y = [], []
+    while True:
+        try:
+            frame = frames.get(timeout=0.05)
+        except queue.Empty:
+            fig.canvas.flush_events()  # keep the window responsive
+            continue
+        if frame is None:
+            break
+
+        rows, xref, ox, oy, target_ind = frame
+        traj_x.extend(rows[:, 1])
+        traj_y.extend(rows[:, 2])
+        time, x, y, yaw, v, di, ai = rows[-1]
+
+        if ox is not None:
+            mpc_line.set_data(ox, oy)
+        else:
+            mpc_line.set_data([], [])
+        traj_line.set_data(traj_x, traj_y)
+        xref_line.set_data(xref[0, :], xref[1, :])
+        target_line.set_data([course_xy[target_ind, 0]], [course_xy[target_ind, 1]])
+        car_plot.update(x, y, yaw, steer=di)
+        title.set_text("Time[s]:" + str(round(time, 2))
+                + ", speed[km/h]:" + str(round(v * 3.6, 2))
+                + ", acc[m/s^2]:" + str(round(ai, 2))
+                + ", steering[rad]:" + str(round(di, 2)))
+        fig.canvas.restore_region(background)
+        for artist in artists:
+            ax.draw_artist(artist)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
+
+    plt.close(fig)
+
 class GetControlInputInfo:
     def __init__(self) -> None:
         platform = 'carla'
@@ -1126,8 +1486,6 @@ class GetControlInputInfo:
 
         self.odem_listener = Odem_Listener(sensors.sensor_config['Odem'])
 
-        self.isODEMGet = False
-        self.isVEHGet = False
         self.isYAWGet = False
 
     def update(self, infos):
@@ -1137,40 +1495,57 @@ class GetControlInputInfo:
         return self.infos
 
     def run(self,):
+        # block on the listener events instead of polling, the vehicle status
+        # only has to be known, every new pose is a new tick. The timeout
+        # only lets the loop notice a shutdown
         while not rospy.is_shutdown():
-            self.ego_vehicle_listner.gathering_msg()
-            self.odem_listener.gathering_msg()
-
-            if self.odem_listener.data_received:
-                ## odem with location and orientation
-                last_location_pose = self.odem_listener.datas[-1].pose.pose
-                last_location_position = last_location_pose.position
-                lat, lon = last_location_position.x, last_location_position.y
-                last_location_orientation = last_location_pose.orientation
-                _, _, yaw = quat2euler(
-                    [last_location_orientation.w,
-                    last_location_orientation.x,
-                    last_location_orientation.y,
-                    last_location_orientation.z])
-                yaw_degree = yaw # radian
-                # yaw_degree = math.degrees(yaw)
-
-                self.isODEMGet = True
+            if not (self.ego_vehicle_listner.updated.wait(timeout=0.1)
+                    and self.odem_listener.updated.wait(timeout=0.1)):
+                continue
+            # cleared before reading, a pose arriving meanwhile signals again
+            self.odem_listener.updated.clear()
+
+            ## odem with location and orientation, parsed by the listener
+            lat, lon, yaw = self.odem_listener.pose
+            yaw_degree = yaw # radian
+            # yaw_degree = math.degrees(yaw)
 
             ## Get vehicle info: Speed, Orientation-> yaw
-            if self.ego_vehicle_listner.data_received:
-                data = self.ego_vehicle_listner.datas[-1]
-                speed = data.velocity
-                throttle = data.control.throttle
-                brake = data.control.brake
-                steering = data.control.steer
-                self.isVEHGet = True
-
-            if self.isODEMGet and self.isVEHGet:
-                print(f'here is {__file__}')
-                infos = [lat, lon, yaw_degree, speed, throttle, brake, steering] # if needs modify here to add or delete infos
-                self.update(infos)
-                return self.get_info()
+            speed, throttle, brake, steering = self.ego_vehicle_listner.status
+
+            rospy.loginfo_throttle(5.0, f'infos updated from {__file__}')
+            infos = [lat, lon, yaw_degree, speed, throttle, brake, steering] # if needs modify here to add or delete infos
+            self.update(infos)
+            return self.get_info()
+
+def generate_mpc_solver(mpc_controller, force=False):
+    """
+    generate the C solver of the mpc qp with cvxpygen
+
+    the qp has fixed dimensions and only its parameters change, so the
+    generated OSQP code skips cvxpy at runtime. It is imported from
+    MPC_GEN_DIR and used when available. The build takes a while and is
+    skipped when the compiled solver of the current MPC_GEN_KEY exists.
+    """
+    if any(MPC_GEN_DIR.glob('cpg_module*')) and not force:
+        print(f"mpc solver already built in {MPC_GEN_DIR}")
+        return
+
+    from cvxpygen import cpg
+
+    # code_dir is the module name, relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(MPC_GEN_DIR.parent)
+    try:
+        cpg.generate_code(mpc_controller.prob, code_dir=MPC_GEN_DIR.name, solver='OSQP',
+                          wrapper=False)
+    finally:
+        os.chdir(cwd)
+
+    # cvxpygen ignores a failed wrapper build, which would leave a
+    # directory without the extension behind, so it is built here
+    subprocess.run([sys.executable, 'setup.py', '--quiet', 'build_ext', '--inplace'],
+                   cwd=MPC_GEN_DIR, check=True)
 
 def test_example_run(getinfo):
     ## Get lat, lon, yaw, speed
@@ -1179,7 +1554,7 @@ def test_example_run(getinfo):
 def test_example_run_mpc(show_animation = False):
     rospy.init_node('Test_mpc_controller')
     options, _ = set_mpc_option()
-    initial_state = options[6]
+    course, initial_state = options[0], options[1]
 
     mpc_controller = MPC_Controller(initial_state)
     t, x, y, yaw, v, d, a = mpc_controller.do_simulation(options)
@@ -1187,7 +1562,7 @@ def test_example_run_mpc(show_animation = False):
     if show_animation:  # pragma: no cover
         plt.close("all")
         plt.subplots()
-        plt.plot(cx, cy, "-r", label="spline")
+        plt.plot(course.xy[:, 0], course.xy[:, 1], "-r", label="spline")
         plt.plot(x, y, "-g", label="tracking")
         plt.grid(True)
         plt.axis("equal")
@@ -1206,14 +1581,14 @@ def test_example_run_mpc(show_animation = False):
 def test_example_pub_with_mpc():
     rospy.init_node('Test_mpc_pub')
     options, getinfo = set_mpc_option()
-    initial_state = options[6]
+    initial_state = options[1]
 
 
     mpc_controller = MPC_Controller(initial_state)
     mpc_controller.do_mpc(options, getinfo)
 
 if __name__ == '__main__':
-    unit_tests = ['getinfo', 'readwaypoints', 'mpc_controller', 'control2carla', ]
+    unit_tests = ['getinfo', 'readwaypoints', 'mpc_controller', 'control2carla', 'codegen', ]
     unit_test = unit_tests[3]
 
     if unit_test == 'getinfo':
@@ -1236,3 +1611,7 @@ if __name__ == '__main__':
         test_example_pub_with_mpc()
         rospy.sleep(10)
 
+    if unit_test == 'codegen':
+        rospy.init_node('Test_mpc_codegen')
+        generate_mpc_solver(MPC_Controller(State()))
+
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import math
 import numpy as np
 import threading
 import rospy
@@ -21,6 +22,12 @@ CARLA_VEHICLE_CONFIG = {
     "Ego_Status": ['/carla/ego_vehicle/vehicle_status', '/Ctrl_CV/control/temp', CarlaEgoVehicleStatus],
     "Ego_Control": ['/Ctrl_CV/planning/local_path', '/carla/ego_vehicle/vehicle_control_cmd', CarlaEgoVehicleControl],
 }
+def quat_to_yaw(w, x, y, z):
+    """
+    yaw of the quaternion, the z angle of quat2euler with the default sxyz axes
+    """
+    return math.atan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+
 class Message_Manager:
     def __init__(self) -> None:
         self.msgs = deque(maxlen=30)
@@ -35,9 +42,10 @@ class Message_Manager:
             return list(self.msgs)
         
 class SensorListener:
-    def __init__(self, sensor_info):
+    def __init__(self, sensor_info, queue_size=None, tcp_nodelay=False):
         sub_topic, pub_topic, msg_type = sensor_info
-        rospy.Subscriber(sub_topic, msg_type, self.callback)
+        rospy.Subscriber(sub_topic, msg_type, self.callback,
+                         queue_size=queue_size, tcp_nodelay=tcp_nodelay)
         self.pub_msg = rospy.Publisher(pub_topic, msg_type, queue_size=1)
         self.bridge = CvBridge()
         self.msg_manager = Message_Manager()
@@ -114,26 +122,43 @@ class VehicleConfig:
 class CarlaEgoVehicle_Listener:
     def __init__(self, vehicle_info):
         sub_topic, pub_topic, msg_type = vehicle_info
-        rospy.Subscriber(sub_topic, msg_type, self.callback)
         self.pub_msg = None
-        self.bridge = CvBridge()
-        self.msg_manager = Message_Manager()
-        self.sensor_data = None
         self.data_received = False
 
-        self.datas = []
-        self.times = []
-        
-    def callback(self, msg):
-        self.msg_manager.add_message(msg)
+        # only the newest status is used, kept with its parsed fields
+        self.latest = None
+        self.status = None  # velocity, throttle, brake, steer
+        self.updated = threading.Event()  # set on every new status
+        # no backlog and no Nagle batching, a late status is a stale one
+        rospy.Subscriber(sub_topic, msg_type, self.callback, queue_size=1, tcp_nodelay=True)
 
-    def gathering_msg(self):
-        self.datas = self.msg_manager.get_msgs()
-        self.data_received = len(self.datas) > 0
+    def callback(self, msg):
+        self.status = (msg.velocity, msg.control.throttle, msg.control.brake, msg.control.steer)
+        self.latest = msg
+        self.data_received = True
+        self.updated.set()
 
-class Odem_Listener(SensorListener):
+class Odem_Listener:
     def __init__(self,sensor_info):
-        super().__init__(sensor_info)
+        sub_topic, pub_topic, msg_type = sensor_info
+        self.pub_msg = None
+        self.data_received = False
+
+        # only the newest odometry is used, kept with its parsed pose
+        self.latest = None
+        self.pose = None  # x, y, yaw
+        self.updated = threading.Event()  # set on every new pose
+        # no backlog and no Nagle batching, a late pose is a stale one
+        rospy.Subscriber(sub_topic, msg_type, self.callback, queue_size=1, tcp_nodelay=True)
+
+    def callback(self, msg):
+        pose = msg.pose.pose
+        orientation = pose.orientation
+        self.pose = (pose.position.x, pose.position.y,
+                     quat_to_yaw(orientation.w, orientation.x, orientation.y, orientation.z))
+        self.latest = msg
+        self.data_received = True
+        self.updated.set()
 
 class Ctrl_CV_CarlaEgoVehicelControl:
     def __init__(self, vehicle_info) -> None: